@@ -5,11 +5,19 @@ import os
 import tempfile
 import logging
 import subprocess
+import shutil
+import threading
+import json
 import time
+import uuid
+from datetime import timezone
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import telebot
 from telebot import types
-from models import create_tables, save_user_history, get_user_history, get_total_user_kruzhoks, set_user_language, get_user_language
+from models import (DATABASE_URL, create_tables, save_user_history, get_user_history, get_total_user_kruzhoks, set_user_language, get_user_language,
+                    append_job_event, get_interrupted_jobs, prune_job_journal, backfill_usage_stats, get_usage_stats,
+                    get_effect_byte_rate, backfill_size_stats)
 
 # Configure logging
 logging.basicConfig(
@@ -21,6 +29,9 @@ logger = logging.getLogger(__name__)
 # Get bot token from environment variables
 BOT_TOKEN = os.getenv('BOT_TOKEN', '7561905786:AAFPVSuvoQipXuVOy2ecm3jCRxyG04e5U6Q')
 
+# Telegram user ids allowed to use admin commands (comma-separated)
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+
 # Initialize bot
 bot = telebot.TeleBot(BOT_TOKEN)
 
@@ -28,6 +39,25 @@ bot = telebot.TeleBot(BOT_TOKEN)
 user_states = {}
 user_media_files = {}
 
+# Jobs created by this process (never treated as interrupted on startup)
+local_job_ids = set()
+
+# Media still waiting on an effect after this long is dropped, and the
+# journal is pruned on the same schedule
+PENDING_JOB_TTL_HOURS = float(os.getenv('PENDING_JOB_TTL_HOURS', '24'))
+JOB_MAINTENANCE_INTERVAL = 3600
+
+# Album (media group) handling: items are collected per media_group_id and
+# flushed once no new item has arrived for ALBUM_DEBOUNCE_SECONDS
+ALBUM_DEBOUNCE_SECONDS = float(os.getenv('ALBUM_DEBOUNCE_SECONDS', '1.5'))
+album_buffers = {}
+album_lock = threading.Lock()
+user_albums = {}
+
+# Worker pool for encoding album items in parallel
+ENCODE_WORKERS = int(os.getenv('ENCODE_WORKERS', str(os.cpu_count() or 2)))
+encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix='encode')
+
 # Effect names mapping
 EFFECT_NAMES = {
     1: "Oddiy",
@@ -37,6 +67,41 @@ EFFECT_NAMES = {
     5: "Aylanish"
 }
 
+# FFmpeg filter each effect depends on (besides scale/crop/format)
+EFFECT_FILTERS = {
+    2: 'zoompan',
+    3: 'gblur',
+    4: 'hue',
+    5: 'rotate'
+}
+
+# Encoders and filters the kruzhok pipeline relies on
+REQUIRED_ENCODERS = ['libx264', 'aac']
+REQUIRED_FILTERS = ['scale', 'crop', 'format', 'zoompan', 'gblur', 'hue', 'rotate']
+
+# Output size budget: above this predicted size kruzhoks are encoded to a
+# target bitrate instead of CRF (0 disables the budget)
+MAX_KRUZHOK_MB = float(os.getenv('MAX_KRUZHOK_MB', '8'))
+DEFAULT_RATE_CONTROL = ['-crf', '23']
+AUDIO_BITRATE_KBPS = 128
+MIN_VIDEO_BITRATE_KBPS = 200
+# Headroom for container overhead and bitrate overshoot
+SIZE_BUDGET_MARGIN = 0.9
+# Predicted sizes below this share of the budget are encoded with uncapped CRF,
+# which keeps unbiased size samples flowing into the predictor
+UNCAPPED_CRF_BUDGET_SHARE = 0.5
+
+# FFmpeg capability cache (probed once, persisted to disk between restarts)
+FFMPEG_CAPS_CACHE = os.getenv(
+    'FFMPEG_CAPS_CACHE',
+    os.path.join(tempfile.gettempdir(), 'kruzhok_ffmpeg_caps.json')
+)
+ffmpeg_caps = None
+
+# Set once infinity_polling has returned; backend-init keeps asking polling to
+# stop until then, since starting to poll clears telebot's own stop flag
+polling_finished = threading.Event()
+
 # Multi-language messages
 MESSAGES = {
     'uz': {
@@ -61,7 +126,10 @@ Tezkor buyruqlar:
         'history_empty': "📭 Hali kruzhok yaratmagansiz. Video yoki rasm yuboring!",
         'history_count': "📊 Jami yaratilgan kruzhoklar: {count} ta",
         'lang_selection': "🌐 Quyidagi tillardan birini tanlang:",
-        'language_set': "✅ Til o'zbekchaga o'rnatildi!"
+        'language_set': "✅ Til o'zbekchaga o'rnatildi!",
+        'stats_header': "📈 Statistika",
+        'stats_totals': "👥 Foydalanuvchilar: {users} | 🎬 Kruzhoklar: {count} | 💾 {size}",
+        'stats_daily': "📅 Oxirgi {days} kun:"
     },
     'ru': {
         'welcome': """👋 Привет, {}!
@@ -85,7 +153,10 @@ Tezkor buyruqlar:
         'history_empty': "📭 Вы еще не создали кружки. Отправьте видео или фото!",
         'history_count': "📊 Всего создано кружков: {count} шт.",
         'lang_selection': "🌐 Выберите один из следующих языков:",
-        'language_set': "✅ Язык установлен на русский!"
+        'language_set': "✅ Язык установлен на русский!",
+        'stats_header': "📈 Статистика",
+        'stats_totals': "👥 Пользователи: {users} | 🎬 Кружки: {count} | 💾 {size}",
+        'stats_daily': "📅 Последние {days} дн.:"
     },
     'en': {
         'welcome': """👋 Hello, {}!
@@ -109,7 +180,10 @@ Quick commands:
         'history_empty': "📭 You haven't created any circles yet. Send a video or photo!",
         'history_count': "📊 Total circles created: {count}",
         'lang_selection': "🌐 Choose one of the following languages:",
-        'language_set': "✅ Language set to English!"
+        'language_set': "✅ Language set to English!",
+        'stats_header': "📈 Statistics",
+        'stats_totals': "👥 Users: {users} | 🎬 Circles: {count} | 💾 {size}",
+        'stats_daily': "📅 Last {days} days:"
     }
 }
 
@@ -129,22 +203,26 @@ def create_language_keyboard():
     markup.add(btn_uz, btn_ru, btn_en)
     return markup
 
-def create_effect_keyboard():
+def create_effect_keyboard(prefix="effect", join_button=False):
     """Create inline keyboard for effect selection"""
     markup = types.InlineKeyboardMarkup(row_width=2)
     
     # Create buttons for each effect
-    btn1 = types.InlineKeyboardButton("📹 Oddiy", callback_data="effect_1")
-    btn2 = types.InlineKeyboardButton("🔍 Zoom", callback_data="effect_2")
-    btn3 = types.InlineKeyboardButton("🌫️ Blur", callback_data="effect_3")
-    btn4 = types.InlineKeyboardButton("🌈 Rang", callback_data="effect_4")
-    btn5 = types.InlineKeyboardButton("🔄 Aylanish", callback_data="effect_5")
+    btn1 = types.InlineKeyboardButton("📹 Oddiy", callback_data=f"{prefix}_1")
+    btn2 = types.InlineKeyboardButton("🔍 Zoom", callback_data=f"{prefix}_2")
+    btn3 = types.InlineKeyboardButton("🌫️ Blur", callback_data=f"{prefix}_3")
+    btn4 = types.InlineKeyboardButton("🌈 Rang", callback_data=f"{prefix}_4")
+    btn5 = types.InlineKeyboardButton("🔄 Aylanish", callback_data=f"{prefix}_5")
     
     # Add buttons to markup
     markup.add(btn1, btn2)
     markup.add(btn3, btn4)
     markup.add(btn5)
     
+    # Albums can also be joined into a single kruzhok
+    if join_button:
+        markup.add(types.InlineKeyboardButton("🔗 Bitta kruzhok", callback_data="album_join"))
+    
     return markup
 
 def create_temp_file(suffix=""):
@@ -162,6 +240,109 @@ def cleanup_file(file_path):
     except Exception as e:
         logger.error(f"Error cleaning up file {file_path}: {e}")
 
+def _ffmpeg_fingerprint():
+    """Identify the installed ffmpeg binary so a stale cache is detected"""
+    ffmpeg_path = shutil.which('ffmpeg')
+    if not ffmpeg_path:
+        return None
+    stat = os.stat(ffmpeg_path)
+    return f"{os.path.realpath(ffmpeg_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+def _list_ffmpeg_names(option):
+    """Return names listed by `ffmpeg -encoders` / `ffmpeg -filters`"""
+    result = subprocess.run(
+        ['ffmpeg', '-hide_banner', option],
+        capture_output=True, text=True, check=True
+    )
+    names = set()
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        # Entries look like " V....D libx264  ..." or " TSC zoompan  V->V ..."
+        if len(parts) >= 2 and not line.startswith(' ' * 2) and parts[0] != '------':
+            names.add(parts[1])
+    return names
+
+def probe_ffmpeg_capabilities():
+    """Probe ffmpeg once: encoder/filter availability and thread count"""
+    fingerprint = _ffmpeg_fingerprint()
+    if fingerprint is None:
+        return {'available': False}
+    encoders = _list_ffmpeg_names('-encoders')
+    filters = _list_ffmpeg_names('-filters')
+    return {
+        'available': True,
+        'fingerprint': fingerprint,
+        'libx264': 'libx264' in encoders,
+        'encoders': {name: name in encoders for name in REQUIRED_ENCODERS},
+        'filters': {name: name in filters for name in REQUIRED_FILTERS},
+        'threads': os.cpu_count() or 1
+    }
+
+def load_cached_ffmpeg_capabilities():
+    """Load ffmpeg capabilities from disk if they match the installed binary"""
+    try:
+        with open(FFMPEG_CAPS_CACHE, 'r') as f:
+            caps = json.load(f)
+        fingerprint = _ffmpeg_fingerprint()
+        if fingerprint and caps.get('fingerprint') == fingerprint:
+            return caps
+    except (OSError, ValueError):
+        pass
+    return None
+
+def save_ffmpeg_capabilities(caps):
+    """Persist probed ffmpeg capabilities to disk"""
+    try:
+        tmp_path = f"{FFMPEG_CAPS_CACHE}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(caps, f)
+        os.replace(tmp_path, FFMPEG_CAPS_CACHE)
+    except OSError as e:
+        logger.error(f"Error saving ffmpeg capabilities: {e}")
+
+def init_ffmpeg_capabilities():
+    """Probe ffmpeg (or load the cached probe) and log what is missing"""
+    global ffmpeg_caps
+    caps = load_cached_ffmpeg_capabilities()
+    if caps is None:
+        try:
+            caps = probe_ffmpeg_capabilities()
+        except (subprocess.CalledProcessError, OSError) as e:
+            logger.error(f"Error probing ffmpeg: {e}")
+            caps = {'available': False}
+        if caps['available']:
+            save_ffmpeg_capabilities(caps)
+    ffmpeg_caps = caps
+    report_ffmpeg_capabilities(caps)
+    return caps
+
+def report_ffmpeg_capabilities(caps):
+    """Log whether ffmpeg is usable and which encoders/filters it lacks"""
+    if not caps['available']:
+        logger.error("FFmpeg is not available. Please install ffmpeg.")
+        return
+    
+    missing = [name for name, ok in caps['encoders'].items() if not ok]
+    missing += [name for name, ok in caps['filters'].items() if not ok]
+    if missing:
+        logger.warning(f"FFmpeg is missing: {', '.join(missing)}")
+    logger.info(f"FFmpeg is available ({caps['threads']} threads)")
+
+def get_ffmpeg_threads():
+    """Get the CPU thread count recorded by the ffmpeg probe"""
+    if ffmpeg_caps and ffmpeg_caps.get('available'):
+        return ffmpeg_caps['threads']
+    return os.cpu_count() or 1
+
+def resolve_effect_type(effect_type):
+    """Fall back to the plain effect if its ffmpeg filter is not available"""
+    filter_name = EFFECT_FILTERS.get(effect_type)
+    if filter_name and ffmpeg_caps and ffmpeg_caps.get('available'):
+        if not ffmpeg_caps['filters'].get(filter_name, True):
+            logger.warning(f"Filter {filter_name} unavailable, using plain effect")
+            return 1
+    return effect_type
+
 def get_video_duration(input_path):
     """Get video duration using ffprobe"""
     try:
@@ -170,7 +351,6 @@ def get_video_duration(input_path):
             '-show_format', '-show_streams', input_path
         ]
         result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        import json
         data = json.loads(result.stdout)
         duration = float(data['format']['duration'])
         return duration
@@ -178,7 +358,64 @@ def get_video_duration(input_path):
         logger.error(f"Error getting video duration: {e}")
         return 10.0  # Default fallback
 
-def process_video_to_kruzhok(input_path, output_path, effect_type=1):
+# Common scaling to a 480x480 square for kruzhok
+BASE_FILTER = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480'
+
+# Effect filters per media type (photos get stronger, slower effects)
+EFFECT_FILTER_CHAINS = {
+    'video': {
+        2: 'zoompan=z=\'min(zoom+0.0015,1.5)\':d=1:x=iw/2-(iw/zoom/2):y=ih/2-(ih/zoom/2)',  # Zoom effekti
+        3: 'gblur=sigma=2:steps=1',  # Blur effekti
+        4: 'hue=h=sin(2*PI*t)*360:s=1.5',  # Rang o'zgarishi effekti
+        5: 'rotate=PI*t/5'  # Aylanish effekti
+    },
+    'photo': {
+        2: 'zoompan=z=\'min(zoom+0.002,1.8)\':d=1:x=iw/2-(iw/zoom/2):y=ih/2-(ih/zoom/2)',  # Zoom effekti
+        3: 'gblur=sigma=3:steps=2',  # Blur effekti
+        4: 'hue=h=sin(2*PI*t/3)*180:s=1.3',  # Rang o'zgarishi effekti
+        5: 'rotate=PI*t/3'  # Aylanish effekti
+    }
+}
+
+def get_effect_filter(effect_type, media_type):
+    """Get the effect part of the filter chain (empty for the plain effect)"""
+    return EFFECT_FILTER_CHAINS[media_type].get(effect_type, '')
+
+def build_video_filter(effect_type, media_type):
+    """Build the full -vf chain for a single input"""
+    effect_filter = get_effect_filter(effect_type, media_type)
+    if effect_filter:
+        return f"{BASE_FILTER},{effect_filter},format=yuv420p"
+    return f"{BASE_FILTER},format=yuv420p"
+
+def plan_rate_control(effect_type, media_type, duration):
+    """Choose the rate control for a kruzhok; returns (args, mode, predicted size, target size)"""
+    # Modes: 'crf' is uncapped CRF (the only mode sampled for prediction),
+    # 'capped_crf' is CRF limited by -maxrate and 'bitrate' targets the budget
+    if MAX_KRUZHOK_MB <= 0 or duration <= 0:
+        return DEFAULT_RATE_CONTROL, 'crf', None, None
+    
+    budget_bytes = MAX_KRUZHOK_MB * 1024 * 1024 * SIZE_BUDGET_MARGIN
+    audio_kbps = AUDIO_BITRATE_KBPS if media_type == 'video' else 0
+    target_kbps = int(budget_bytes * 8 / 1000 / duration) - audio_kbps
+    target_kbps = max(target_kbps, MIN_VIDEO_BITRATE_KBPS)
+    target_size = int((target_kbps + audio_kbps) * 1000 / 8 * duration)
+    capped = ['-maxrate', f'{target_kbps}k', '-bufsize', f'{target_kbps * 2}k']
+    
+    # Past uncapped CRF outputs of this effect predict the size of this one.
+    # Until there are enough samples, encode uncapped to collect them.
+    byte_rate = get_effect_byte_rate(effect_type, media_type)
+    if not byte_rate:
+        return DEFAULT_RATE_CONTROL, 'crf', None, target_size
+    
+    predicted_size = int(byte_rate * duration)
+    if predicted_size <= budget_bytes * UNCAPPED_CRF_BUDGET_SHARE:
+        return DEFAULT_RATE_CONTROL, 'crf', predicted_size, target_size
+    if predicted_size <= budget_bytes:
+        return DEFAULT_RATE_CONTROL + capped, 'capped_crf', predicted_size, target_size
+    return ['-b:v', f'{target_kbps}k'] + capped, 'bitrate', predicted_size, target_size
+
+def process_video_to_kruzhok(input_path, output_path, effect_type=1, threads=None, rate_control=None):
     """Convert video to circular kruzhok format using ffmpeg with effects"""
     try:
         # Get video info first
@@ -187,19 +424,10 @@ def process_video_to_kruzhok(input_path, output_path, effect_type=1):
         # Limit duration to 60 seconds for kruzhok
         duration = min(duration, 60.0)
         
+        effect_type = resolve_effect_type(effect_type)
+        
         # Define video filter based on effect type
-        if effect_type == 1:  # Oddiy dumaloq video
-            video_filter = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480,format=yuv420p'
-        elif effect_type == 2:  # Zoom effekti
-            video_filter = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480,zoompan=z=\'min(zoom+0.0015,1.5)\':d=1:x=iw/2-(iw/zoom/2):y=ih/2-(ih/zoom/2),format=yuv420p'
-        elif effect_type == 3:  # Blur effekti
-            video_filter = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480,gblur=sigma=2:steps=1,format=yuv420p'
-        elif effect_type == 4:  # Rang o'zgarishi effekti
-            video_filter = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480,hue=h=sin(2*PI*t)*360:s=1.5,format=yuv420p'
-        elif effect_type == 5:  # Aylanish effekti
-            video_filter = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480,rotate=PI*t/5,format=yuv420p'
-        else:
-            video_filter = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480,format=yuv420p'
+        video_filter = build_video_filter(effect_type, 'video')
         
         # FFmpeg command to create circular video with effects
         cmd = [
@@ -213,9 +441,11 @@ def process_video_to_kruzhok(input_path, output_path, effect_type=1):
             '-ar', '44100',     # Audio sample rate
             '-ac', '2',         # Audio channels
             '-preset', 'fast',  # Encoding preset
-            '-crf', '23',       # Quality setting
-            output_path
         ]
+        cmd += rate_control or DEFAULT_RATE_CONTROL  # Quality / size setting
+        if threads:
+            cmd += ['-threads', str(threads)]
+        cmd.append(output_path)
         
         logger.info(f"Running ffmpeg command: {' '.join(cmd)}")
         result = subprocess.run(cmd, capture_output=True, text=True, check=True)
@@ -229,22 +459,13 @@ def process_video_to_kruzhok(input_path, output_path, effect_type=1):
         logger.error(f"Error processing video: {e}")
         return False
 
-def process_photo_to_kruzhok(input_path, output_path, effect_type=1):
+def process_photo_to_kruzhok(input_path, output_path, effect_type=1, threads=None, rate_control=None):
     """Convert photo to 5-second circular kruzhok with effects"""
     try:
+        effect_type = resolve_effect_type(effect_type)
+        
         # Define video filter based on effect type
-        if effect_type == 1:  # Oddiy dumaloq video
-            video_filter = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480,format=yuv420p'
-        elif effect_type == 2:  # Zoom effekti
-            video_filter = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480,zoompan=z=\'min(zoom+0.002,1.8)\':d=1:x=iw/2-(iw/zoom/2):y=ih/2-(ih/zoom/2),format=yuv420p'
-        elif effect_type == 3:  # Blur effekti
-            video_filter = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480,gblur=sigma=3:steps=2,format=yuv420p'
-        elif effect_type == 4:  # Rang o'zgarishi effekti
-            video_filter = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480,hue=h=sin(2*PI*t/3)*180:s=1.3,format=yuv420p'
-        elif effect_type == 5:  # Aylanish effekti
-            video_filter = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480,rotate=PI*t/3,format=yuv420p'
-        else:
-            video_filter = 'scale=480:480:force_original_aspect_ratio=increase,crop=480:480,format=yuv420p'
+        video_filter = build_video_filter(effect_type, 'photo')
         
         # FFmpeg command to create 5-second circular video from image with effects
         cmd = [
@@ -257,9 +478,11 @@ def process_photo_to_kruzhok(input_path, output_path, effect_type=1):
             '-pix_fmt', 'yuv420p',
             '-r', '25',         # Frame rate
             '-preset', 'fast',  # Encoding preset
-            '-crf', '23',       # Quality setting
-            output_path
         ]
+        cmd += rate_control or DEFAULT_RATE_CONTROL  # Quality / size setting
+        if threads:
+            cmd += ['-threads', str(threads)]
+        cmd.append(output_path)
         
         logger.info(f"Running ffmpeg command for photo: {' '.join(cmd)}")
         result = subprocess.run(cmd, capture_output=True, text=True, check=True)
@@ -273,6 +496,404 @@ def process_photo_to_kruzhok(input_path, output_path, effect_type=1):
         logger.error(f"Error processing photo: {e}")
         return False
 
+def process_album_to_kruzhok(items, output_path, effect_type=1, rate_control=None):
+    """Join album items into one kruzhok, decoding each input exactly once"""
+    try:
+        effect_type = resolve_effect_type(effect_type)
+        
+        cmd = ['ffmpeg', '-y']
+        chains = []
+        labels = ''
+        for index, item in enumerate(items):
+            if item['media_type'] == 'photo':
+                cmd += ['-loop', '1', '-t', '5', '-i', item['file_path']]
+            else:
+                cmd += ['-t', str(min(get_video_duration(item['file_path']), 60.0)), '-i', item['file_path']]
+            # Normalize every item so they can be concatenated
+            chains.append(f"[{index}:v]{BASE_FILTER},setsar=1,fps=25,format=yuv420p[v{index}]")
+            labels += f"[v{index}]"
+        
+        effect_filter = get_effect_filter(effect_type, 'video')
+        joined = f"{labels}concat=n={len(items)}:v=1:a=0"
+        if effect_filter:
+            joined += f",{effect_filter}"
+        chains.append(f"{joined},format=yuv420p[out]")
+        
+        # Items may or may not have audio, so the joined kruzhok is silent
+        cmd += [
+            '-filter_complex', ';'.join(chains),
+            '-map', '[out]',
+            '-t', '60',         # Kruzhok length limit
+            '-an',
+            '-c:v', 'libx264',  # Video codec
+            '-preset', 'fast',  # Encoding preset
+        ]
+        cmd += rate_control or DEFAULT_RATE_CONTROL  # Quality / size setting
+        cmd.append(output_path)
+        
+        logger.info(f"Running ffmpeg command for album: {' '.join(cmd)}")
+        subprocess.run(cmd, capture_output=True, text=True, check=True)
+        logger.info("Album processing completed successfully")
+        return True
+        
+    except subprocess.CalledProcessError as e:
+        logger.error(f"FFmpeg error for album: {e.stderr}")
+        return False
+    except Exception as e:
+        logger.error(f"Error processing album: {e}")
+        return False
+
+def create_job(message, file_path, media_type, duration):
+    """Create a job for media that is about to be downloaded and journal it"""
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'user_id': message.from_user.id,
+        'chat_id': message.chat.id,
+        'message_id': message.message_id,
+        'username': message.from_user.username,
+        'first_name': message.from_user.first_name,
+        'file_path': file_path,
+        'media_type': media_type,
+        'duration': duration,
+        'media_group_id': message.media_group_id,
+        'created_at': time.time()
+    }
+    local_job_ids.add(job['job_id'])
+    journal_job(job, 'downloading')
+    return job
+
+def create_joined_job(jobs):
+    """Create one job that joins all album items into a single kruzhok"""
+    first = jobs[0]
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'user_id': first['user_id'],
+        'chat_id': first['chat_id'],
+        'message_id': first['message_id'],
+        'username': first['username'],
+        'first_name': first['first_name'],
+        'file_path': first['file_path'],
+        'media_type': 'album',
+        'duration': min(sum(item['duration'] for item in jobs), 60),
+        'media_group_id': first['media_group_id'],
+        'created_at': first['created_at'],
+        'items': [{'file_path': item['file_path'], 'media_type': item['media_type']} for item in jobs]
+    }
+    local_job_ids.add(job['job_id'])
+    return job
+
+def journal_job(job, stage):
+    """Move a job to a new stage and append it to the job journal"""
+    job['stage'] = stage
+    append_job_event(job['job_id'], job['user_id'], job['chat_id'], stage, json.dumps(job))
+
+def get_job_inputs(job):
+    """Get all input files of a job"""
+    if 'items' in job:
+        return [item['file_path'] for item in job['items']]
+    return [job['file_path']]
+
+def finish_job(job, stage, cleanup=True):
+    """Record a final job stage, remove its files and clear the user's state"""
+    journal_job(job, stage)
+    local_job_ids.discard(job['job_id'])
+    if cleanup:
+        for file_path in get_job_inputs(job):
+            cleanup_file(file_path)
+        if job.get('output_path'):
+            cleanup_file(job['output_path'])
+    
+    user_id = job['user_id']
+    current = user_media_files.get(user_id)
+    if current is not None and current['job_id'] == job['job_id']:
+        del user_media_files[user_id]
+        if user_id in user_states:
+            del user_states[user_id]
+
+def take_user_job(user_id):
+    """Remove and return the user's pending job, if any"""
+    job = user_media_files.pop(user_id, None)
+    if job is not None and user_id not in user_albums and user_id in user_states:
+        del user_states[user_id]
+    return job
+
+def take_user_album(user_id):
+    """Remove and return the user's pending album, if any"""
+    album = user_albums.pop(user_id, None)
+    if album is not None and user_id not in user_media_files and user_id in user_states:
+        del user_states[user_id]
+    return album
+
+def discard_pending_media(user_id):
+    """Drop the user's pending job and album, removing their files"""
+    # Jobs already being processed were taken out of the pending slots and
+    # own their files; only media still waiting on an effect is dropped
+    pending = []
+    previous = take_user_job(user_id)
+    if previous is not None:
+        pending.append(previous)
+    album = take_user_album(user_id)
+    if album is not None:
+        pending.extend(album['jobs'])
+    for job in pending:
+        if job['stage'] == 'downloaded':
+            finish_job(job, 'failed')
+
+def replace_user_job(user_id, job):
+    """Make job the user's pending job, discarding the previous one"""
+    previous = user_media_files.get(user_id)
+    if previous is None or previous['job_id'] != job['job_id']:
+        discard_pending_media(user_id)
+    user_media_files[user_id] = job
+    user_states[user_id] = 'choosing_effect'
+
+def replace_user_album(user_id, jobs):
+    """Make an album the user's pending media, discarding the previous one"""
+    discard_pending_media(user_id)
+    user_albums[user_id] = {'media_group_id': jobs[0]['media_group_id'], 'jobs': jobs}
+    user_states[user_id] = 'choosing_effect'
+
+def offer_album_effects(jobs, reply_to_message_id=None):
+    """Register collected album items and show one effect keyboard for them"""
+    user_id = jobs[0]['user_id']
+    chat_id = jobs[0]['chat_id']
+    media_group_id = jobs[0]['media_group_id']
+    messages = get_user_messages(user_id)
+    
+    # Items arriving after the debounce already flushed join the offered album
+    pending_album = user_albums.get(user_id)
+    if pending_album is not None and pending_album['media_group_id'] == media_group_id:
+        pending_album['jobs'] = sorted(pending_album['jobs'] + jobs, key=lambda item: item['message_id'])
+        return
+    pending_job = user_media_files.get(user_id)
+    if pending_job is not None and media_group_id and pending_job.get('media_group_id') == media_group_id:
+        take_user_job(user_id)
+        jobs = sorted([pending_job] + jobs, key=lambda item: item['message_id'])
+    
+    if len(jobs) == 1:
+        replace_user_job(user_id, jobs[0])
+        markup = create_effect_keyboard()
+    else:
+        replace_user_album(user_id, jobs)
+        markup = create_effect_keyboard(prefix="albumeffect", join_button=True)
+    bot.send_message(chat_id, messages['choose_effect'], reply_to_message_id=reply_to_message_id, reply_markup=markup)
+
+def begin_album_item(message):
+    """Register an album item whose download is starting"""
+    with album_lock:
+        album = album_buffers.get(message.media_group_id)
+        if album is None:
+            album = {'jobs': [], 'pending': 0, 'timer': None}
+            album_buffers[message.media_group_id] = album
+        if album['timer'] is not None:
+            album['timer'].cancel()
+            album['timer'] = None
+        album['pending'] += 1
+
+def end_album_item(media_group_id, job):
+    """Add a downloaded album item (None if it failed) and re-arm the debounce"""
+    with album_lock:
+        album = album_buffers[media_group_id]
+        album['pending'] -= 1
+        if job is not None:
+            album['jobs'].append(job)
+        if album['pending'] == 0:
+            album['timer'] = threading.Timer(ALBUM_DEBOUNCE_SECONDS, flush_album, args=(media_group_id,))
+            album['timer'].daemon = True
+            album['timer'].start()
+
+def flush_album(media_group_id):
+    """Show the effect keyboard once all album items have arrived"""
+    with album_lock:
+        album = album_buffers.get(media_group_id)
+        if album is None or album['pending'] > 0:
+            return
+        del album_buffers[media_group_id]
+    
+    jobs = sorted(album['jobs'], key=lambda item: item['message_id'])
+    if not jobs:
+        return
+    try:
+        offer_album_effects(jobs, reply_to_message_id=jobs[0]['message_id'])
+    except Exception as e:
+        logger.error(f"Error offering effects for album {media_group_id}: {e}")
+
+def encode_job(job):
+    """Run the encoding stage of a job"""
+    success = False
+    threads = job.get('threads')
+    duration = min(job['duration'], 60)
+    rate_control, job['encode_mode'], job['predicted_size'], job['target_size'] = plan_rate_control(
+        job['effect_type'], job['media_type'], duration
+    )
+    if job['media_type'] == 'video':
+        success = process_video_to_kruzhok(job['file_path'], job['output_path'], job['effect_type'], threads, rate_control)
+    elif job['media_type'] == 'photo':
+        success = process_photo_to_kruzhok(job['file_path'], job['output_path'], job['effect_type'], threads, rate_control)
+    elif job['media_type'] == 'album':
+        success = process_album_to_kruzhok(job['items'], job['output_path'], job['effect_type'], rate_control)
+    if success:
+        job['file_size'] = os.path.getsize(job['output_path'])
+        logger.info(
+            f"Job {job['job_id']} size: predicted {job['predicted_size']} bytes, "
+            f"target {job['target_size']} bytes, actual {job['file_size']} bytes ({job['encode_mode']} mode)"
+        )
+        journal_job(job, 'encoded')
+    return success
+
+def run_job(job):
+    """Run a job from its last finished stage: encode, upload, save history"""
+    if job['stage'] == 'encoding':
+        if not encode_job(job):
+            return False
+    
+    if job['stage'] == 'encoded':
+        # Send the kruzhok
+        with open(job['output_path'], 'rb') as video:
+            sent_message = bot.send_video_note(
+                job['chat_id'],
+                video,
+                duration=job['duration'],
+                length=480  # Circular video diameter
+            )
+        job['file_id'] = sent_message.video_note.file_id
+        journal_job(job, 'uploaded')
+    
+    if job['stage'] == 'uploaded':
+        # Save to history
+        effect_type = job['effect_type']
+        save_user_history(
+            user_id=job['user_id'],
+            username=job['username'],
+            first_name=job['first_name'],
+            file_id=job['file_id'],
+            original_media_type=job['media_type'],
+            effect_type=effect_type,
+            effect_name=EFFECT_NAMES.get(effect_type, f"Effekt {effect_type}"),
+            file_size=job.get('file_size'),
+            # Only uncapped CRF sizes are used as samples for predicting future sizes
+            duration=min(job['duration'], 60) if job.get('encode_mode') == 'crf' else None
+        )
+        # Journal the write so a resumed job never saves the same kruzhok twice
+        journal_job(job, 'saved')
+    return True
+
+def resume_job(job):
+    """Resume an interrupted job from its last finished stage"""
+    stage = job['stage']
+    user_id = job['user_id']
+    messages = get_user_messages(user_id)
+    inputs_exist = all(os.path.exists(file_path) for file_path in get_job_inputs(job))
+    
+    if stage == 'downloading':
+        # The download never finished, so only the partial file is left
+        finish_job(job, 'failed')
+        return
+    if stage in ('downloaded', 'encoding') and not inputs_exist:
+        logger.warning(f"Job {job['job_id']} input is gone, dropping it")
+        finish_job(job, 'failed')
+        return
+    if stage == 'encoded' and not os.path.exists(job['output_path']):
+        # Encoded output is gone but the input may still be there
+        if not inputs_exist:
+            finish_job(job, 'failed')
+            return
+        job['stage'] = 'encoding'
+    
+    if stage == 'downloaded':
+        # User was choosing an effect; ask again unless they already sent new media
+        if user_id in user_media_files or user_id in user_albums:
+            finish_job(job, 'failed')
+            return
+        replace_user_job(user_id, job)
+        bot.send_message(job['chat_id'], messages['choose_effect'], reply_markup=create_effect_keyboard())
+        return
+    
+    logger.info(f"Resuming job {job['job_id']} from stage {job['stage']}")
+    success = run_job(job)
+    status_message_id = job.get('status_message_id')
+    if status_message_id:
+        try:
+            if success:
+                bot.delete_message(job['chat_id'], status_message_id)
+            else:
+                bot.edit_message_text(messages['error'], job['chat_id'], status_message_id)
+        except Exception as e:
+            logger.error(f"Error updating status message for job {job['job_id']}: {e}")
+    finish_job(job, 'done' if success else 'failed')
+
+def resume_album(jobs):
+    """Ask again for the effect of an album that was waiting on a choice"""
+    user_id = jobs[0]['user_id']
+    if user_id in user_media_files or user_id in user_albums:
+        for job in jobs:
+            finish_job(job, 'failed')
+        return
+    
+    available = []
+    for job in jobs:
+        if os.path.exists(job['file_path']):
+            available.append(job)
+        else:
+            finish_job(job, 'failed')
+    if available:
+        offer_album_effects(sorted(available, key=lambda item: item['message_id']))
+
+def is_job_expired(job):
+    """Check whether a job waiting on an effect has outlived PENDING_JOB_TTL_HOURS"""
+    return job['stage'] == 'downloaded' and time.time() - job['created_at'] > PENDING_JOB_TTL_HOURS * 3600
+
+def resume_interrupted_jobs():
+    """Resume or clean up jobs interrupted by a restart"""
+    waiting_albums = {}
+    for entry in get_interrupted_jobs():
+        job = json.loads(entry.data)
+        if job['job_id'] in local_job_ids:
+            continue
+        job.setdefault('created_at', entry.created_at.replace(tzinfo=timezone.utc).timestamp())
+        # Users who never picked an effect are not asked again on every restart
+        if is_job_expired(job):
+            finish_job(job, 'failed')
+            continue
+        # Album items still waiting on an effect are offered again together
+        if job['stage'] == 'downloaded' and job.get('media_group_id'):
+            waiting_albums.setdefault(job['media_group_id'], []).append(job)
+            continue
+        try:
+            resume_job(job)
+        except Exception as e:
+            logger.error(f"Error resuming job {job['job_id']}: {e}")
+            finish_job(job, 'failed')
+    
+    for media_group_id, jobs in waiting_albums.items():
+        try:
+            resume_album(jobs)
+        except Exception as e:
+            logger.error(f"Error resuming album {media_group_id}: {e}")
+            for job in jobs:
+                finish_job(job, 'failed')
+
+def expire_pending_jobs():
+    """Drop pending media whose users never picked an effect"""
+    for user_id, job in list(user_media_files.items()):
+        if is_job_expired(job) and take_user_job(user_id) is job:
+            finish_job(job, 'failed')
+    for user_id, album in list(user_albums.items()):
+        if is_job_expired(album['jobs'][0]) and take_user_album(user_id) is album:
+            for job in album['jobs']:
+                finish_job(job, 'failed')
+
+def run_job_maintenance():
+    """Expire abandoned pending media and prune finished journal entries, then reschedule"""
+    try:
+        expire_pending_jobs()
+        prune_job_journal()
+    except Exception as e:
+        logger.error(f"Error running job maintenance: {e}")
+    timer = threading.Timer(JOB_MAINTENANCE_INTERVAL, run_job_maintenance)
+    timer.daemon = True
+    timer.start()
+
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
     """Handle /start command - show language selection for new users"""
@@ -333,30 +954,82 @@ def send_history(message):
         messages = get_user_messages(user_id)
         bot.reply_to(message, messages['error'])
 
+def format_size(size):
+    """Format a byte count for display"""
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+@bot.message_handler(commands=['stats'], func=lambda message: message.from_user.id in ADMIN_IDS)
+def send_stats(message):
+    """Handle /stats command - show usage rollups to admins"""
+    try:
+        user_id = message.from_user.id
+        messages = get_user_messages(user_id)
+        days = 7
+        stats = get_usage_stats(days=days)
+        
+        if stats is None:
+            bot.reply_to(message, messages['error'])
+            return
+        
+        lines = [
+            messages['stats_header'],
+            messages['stats_totals'].format(
+                users=stats['total_users'],
+                count=stats['total_kruzhoks'],
+                size=format_size(stats['total_bytes'])
+            ),
+            "",
+            messages['stats_daily'].format(days=days)
+        ]
+        current_day = None
+        for row in stats['daily']:
+            if row.day != current_day:
+                current_day = row.day
+                lines.append(f"\n{row.day.strftime('%d.%m.%Y')}")
+            effect_name = EFFECT_NAMES.get(row.effect_type, f"Effekt {row.effect_type}")
+            lines.append(f"🎨 {effect_name} ({row.media_type}): {row.kruzhok_count} | {format_size(row.total_bytes)}")
+        
+        bot.reply_to(message, "\n".join(lines))
+        
+    except Exception as e:
+        logger.error(f"Error handling stats command: {e}")
+        messages = get_user_messages(user_id)
+        bot.reply_to(message, messages['error'])
+
 @bot.message_handler(content_types=['video'])
 def handle_video(message):
     """Handle video messages"""
+    job = None
+    media_group_id = message.media_group_id
+    if media_group_id:
+        begin_album_item(message)
     try:
         user_id = message.from_user.id
         
         # Get file info
         file_info = bot.get_file(message.video.file_id)
         
-        # Create temporary file
+        # Create temporary file and journal it before downloading
         input_file = create_temp_file(suffix='.mp4')
+        job = create_job(message, input_file, 'video', message.video.duration or 10)
         
         # Download the video
         downloaded_file = bot.download_file(file_info.file_path)
         with open(input_file, 'wb') as f:
             f.write(downloaded_file)
+        journal_job(job, 'downloaded')
         
         # Store user media file and set state
-        user_media_files[user_id] = {
-            'file_path': input_file,
-            'media_type': 'video',
-            'duration': message.video.duration or 10
-        }
-        user_states[user_id] = 'choosing_effect'
+        # Album items share one effect keyboard, shown once all have arrived
+        if media_group_id:
+            end_album_item(media_group_id, job)
+            media_group_id = None
+            return
+        replace_user_job(user_id, job)
         
         # Send effect selection menu with inline keyboard
         messages = get_user_messages(user_id)
@@ -365,12 +1038,21 @@ def handle_video(message):
             
     except Exception as e:
         logger.error(f"Error handling video: {e}")
+        if job is not None and job['stage'] == 'downloading':
+            finish_job(job, 'failed')
         messages = get_user_messages(user_id)
         bot.reply_to(message, messages['error'])
+    finally:
+        if media_group_id:
+            end_album_item(media_group_id, None)
 
 @bot.message_handler(content_types=['photo'])
 def handle_photo(message):
     """Handle photo messages"""
+    job = None
+    media_group_id = message.media_group_id
+    if media_group_id:
+        begin_album_item(message)
     try:
         user_id = message.from_user.id
         
@@ -378,21 +1060,23 @@ def handle_photo(message):
         photo = message.photo[-1]
         file_info = bot.get_file(photo.file_id)
         
-        # Create temporary file
+        # Create temporary file and journal it before downloading
         input_file = create_temp_file(suffix='.jpg')
+        job = create_job(message, input_file, 'photo', 5)
         
         # Download the photo
         downloaded_file = bot.download_file(file_info.file_path)
         with open(input_file, 'wb') as f:
             f.write(downloaded_file)
+        journal_job(job, 'downloaded')
         
         # Store user media file and set state
-        user_media_files[user_id] = {
-            'file_path': input_file,
-            'media_type': 'photo',
-            'duration': 5
-        }
-        user_states[user_id] = 'choosing_effect'
+        # Album items share one effect keyboard, shown once all have arrived
+        if media_group_id:
+            end_album_item(media_group_id, job)
+            media_group_id = None
+            return
+        replace_user_job(user_id, job)
         
         # Send effect selection menu with inline keyboard
         messages = get_user_messages(user_id)
@@ -401,8 +1085,13 @@ def handle_photo(message):
             
     except Exception as e:
         logger.error(f"Error handling photo: {e}")
+        if job is not None and job['stage'] == 'downloading':
+            finish_job(job, 'failed')
         messages = get_user_messages(user_id)
         bot.reply_to(message, messages['error'])
+    finally:
+        if media_group_id:
+            end_album_item(media_group_id, None)
 
 @bot.message_handler(content_types=['document', 'audio', 'voice', 'sticker'])
 def handle_unsupported(message):
@@ -427,6 +1116,39 @@ def handle_effect_callback(call):
         logger.error(f"Error handling effect callback: {e}")
         bot.answer_callback_query(call.id, text="❌ Xatolik yuz berdi")
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith('albumeffect_'))
+def handle_album_effect_callback(call):
+    """Handle effect selection for an album, one kruzhok per item"""
+    try:
+        effect_type = int(call.data.split('_')[1])
+        bot.answer_callback_query(call.id)
+        process_album_with_effect_callback(call, effect_type)
+    except Exception as e:
+        logger.error(f"Error handling album effect callback: {e}")
+        bot.answer_callback_query(call.id, text="❌ Xatolik yuz berdi")
+
+@bot.callback_query_handler(func=lambda call: call.data == 'album_join')
+def handle_album_join_callback(call):
+    """Handle the album button that joins all items into one kruzhok"""
+    try:
+        bot.answer_callback_query(call.id)
+        markup = create_effect_keyboard(prefix="joineffect")
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=markup)
+    except Exception as e:
+        logger.error(f"Error handling album join callback: {e}")
+        bot.answer_callback_query(call.id, text="❌ Xatolik yuz berdi")
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('joineffect_'))
+def handle_join_effect_callback(call):
+    """Handle effect selection for a joined album"""
+    try:
+        effect_type = int(call.data.split('_')[1])
+        bot.answer_callback_query(call.id)
+        process_album_with_effect_callback(call, effect_type, join=True)
+    except Exception as e:
+        logger.error(f"Error handling join effect callback: {e}")
+        bot.answer_callback_query(call.id, text="❌ Xatolik yuz berdi")
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith('lang_'))
 def handle_language_callback(call):
     """Handle language selection callbacks"""
@@ -474,110 +1196,177 @@ def handle_text_messages(message):
 def process_media_with_effect_callback(call, effect_type):
     """Process stored media with selected effect from callback"""
     user_id = call.from_user.id
+    job = None
     
     try:
         messages = get_user_messages(user_id)
         
-        if user_id not in user_media_files:
+        # Take the job out of the pending slot so new uploads cannot discard it
+        job = take_user_job(user_id)
+        if job is None:
             bot.edit_message_text(messages['error'], call.message.chat.id, call.message.message_id)
             return
         
         # Edit message to show processing
         bot.edit_message_text(messages['effect_processing'], call.message.chat.id, call.message.message_id)
         
-        media_info = user_media_files[user_id]
-        input_file = media_info['file_path']
-        output_file = create_temp_file(suffix='.mp4')
-        
-        # Process based on media type
-        success = False
-        if media_info['media_type'] == 'video':
-            success = process_video_to_kruzhok(input_file, output_file, effect_type)
-        elif media_info['media_type'] == 'photo':
-            success = process_photo_to_kruzhok(input_file, output_file, effect_type)
-        
-        if success:
-            # Send the kruzhok
-            with open(output_file, 'rb') as video:
-                sent_message = bot.send_video_note(
-                    call.message.chat.id,
-                    video,
-                    duration=media_info['duration'],
-                    length=480  # Circular video diameter
-                )
-            
-            # Save to history
-            effect_name = EFFECT_NAMES.get(effect_type, f"Effekt {effect_type}")
-            file_size = os.path.getsize(output_file) if os.path.exists(output_file) else None
-            
-            save_user_history(
-                user_id=user_id,
-                username=call.from_user.username,
-                first_name=call.from_user.first_name,
-                file_id=sent_message.video_note.file_id,
-                original_media_type=media_info['media_type'],
-                effect_type=effect_type,
-                effect_name=effect_name,
-                file_size=file_size
-            )
-            
+        job['effect_type'] = effect_type
+        job['output_path'] = create_temp_file(suffix='.mp4')
+        job['status_message_id'] = call.message.message_id
+        journal_job(job, 'encoding')
+        
+        if run_job(job):
             # Delete processing message
             bot.delete_message(call.message.chat.id, call.message.message_id)
+            finish_job(job, 'done')
         else:
             bot.edit_message_text(
                 messages['error'],
                 call.message.chat.id,
                 call.message.message_id
             )
-        
-        # Clean up
-        cleanup_file(input_file)
-        cleanup_file(output_file)
-        
-        # Clear user state
-        if user_id in user_states:
-            del user_states[user_id]
-        if user_id in user_media_files:
-            del user_media_files[user_id]
+            finish_job(job, 'failed')
             
     except Exception as e:
         logger.error(f"Error processing media with effect: {e}")
         messages = get_user_messages(user_id)
         bot.edit_message_text(messages['error'], call.message.chat.id, call.message.message_id)
         
-        # Clear user state on error
-        if user_id in user_states:
-            del user_states[user_id]
-        if user_id in user_media_files:
-            cleanup_file(user_media_files[user_id]['file_path'])
-            del user_media_files[user_id]
+        # Clean up the job this callback was processing
+        if job is not None and job.get('stage') not in ('done', 'failed'):
+            finish_job(job, 'failed')
 
-def main():
-    """Main function to start the bot"""
-    logger.info("Starting Kruzhok Bot...")
+def process_album_with_effect_callback(call, effect_type, join=False):
+    """Process a stored album with selected effect, one kruzhok per item or joined"""
+    user_id = call.from_user.id
+    jobs = []
     
-    # Initialize database
+    try:
+        messages = get_user_messages(user_id)
+        album = take_user_album(user_id)
+        
+        if album is None:
+            bot.edit_message_text(messages['error'], call.message.chat.id, call.message.message_id)
+            return
+        
+        # Edit message to show processing
+        bot.edit_message_text(messages['effect_processing'], call.message.chat.id, call.message.message_id)
+        
+        jobs = album['jobs']
+        if join:
+            joined = create_joined_job(jobs)
+            joined['effect_type'] = effect_type
+            joined['output_path'] = create_temp_file(suffix='.mp4')
+            joined['status_message_id'] = call.message.message_id
+            journal_job(joined, 'encoding')
+            # The joined job now owns the item files
+            for job in jobs:
+                finish_job(job, 'merged', cleanup=False)
+            jobs = [joined]
+        else:
+            # Split the CPU between the items encoded at the same time
+            threads = max(1, get_ffmpeg_threads() // min(len(jobs), ENCODE_WORKERS))
+            for job in jobs:
+                job['effect_type'] = effect_type
+                job['output_path'] = create_temp_file(suffix='.mp4')
+                job['status_message_id'] = call.message.message_id
+                job['threads'] = threads
+                journal_job(job, 'encoding')
+        
+        # Encode every item on the worker pool, then upload in album order
+        futures = [encode_pool.submit(encode_job, job) for job in jobs]
+        all_success = True
+        for job, future in zip(jobs, futures):
+            try:
+                success = future.result() and run_job(job)
+            except Exception as e:
+                logger.error(f"Error processing album job {job['job_id']}: {e}")
+                success = False
+            finish_job(job, 'done' if success else 'failed')
+            all_success = all_success and success
+        
+        if all_success:
+            # Delete processing message
+            bot.delete_message(call.message.chat.id, call.message.message_id)
+        else:
+            bot.edit_message_text(
+                messages['error'],
+                call.message.chat.id,
+                call.message.message_id
+            )
+            
+    except Exception as e:
+        logger.error(f"Error processing album with effect: {e}")
+        messages = get_user_messages(user_id)
+        bot.edit_message_text(messages['error'], call.message.chat.id, call.message.message_id)
+        
+        # Clear album jobs on error
+        for job in jobs:
+            if job.get('stage') not in ('done', 'failed', 'merged'):
+                finish_job(job, 'failed')
+
+def stop_bot():
+    """Stop polling, retrying until it has really stopped"""
+    while not polling_finished.wait(1):
+        bot.stop_polling()
+
+def initialize_backend():
+    """Create database tables, probe ffmpeg and resume jobs without blocking polling"""
     try:
         create_tables()
         logger.info("Database tables initialized successfully")
     except Exception as e:
         logger.error(f"Error initializing database: {e}")
+        # Without a database the bot cannot work; stop instead of failing every job
+        stop_bot()
         return
     
-    # Check if ffmpeg is available
-    try:
-        subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-        logger.info("FFmpeg is available")
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    if ffmpeg_caps is None and not init_ffmpeg_capabilities()['available']:
+        stop_bot()
+        return
+    
+    # Rollups start empty on existing installs; build them from history once
+    if backfill_usage_stats():
+        logger.info("Usage statistics backfilled from history")
+    if backfill_size_stats():
+        logger.info("Photo size samples backfilled from history")
+    
+    # Pick up jobs that were in flight when the process last stopped
+    resume_interrupted_jobs()
+    run_job_maintenance()
+
+def main():
+    """Main function to start the bot"""
+    global ffmpeg_caps
+    logger.info("Starting Kruzhok Bot...")
+    
+    # Cheap checks first, so a missing database URL or ffmpeg stops the bot before polling
+    if not DATABASE_URL:
+        logger.error("DATABASE_URL environment variable is required")
+        return
+    if shutil.which('ffmpeg') is None:
         logger.error("FFmpeg is not available. Please install ffmpeg.")
         return
     
+    # A cached ffmpeg probe is a cheap file read; it spares the background probe
+    cached_caps = load_cached_ffmpeg_capabilities()
+    if cached_caps is not None:
+        ffmpeg_caps = cached_caps
+        logger.info("FFmpeg capabilities loaded from cache")
+        report_ffmpeg_capabilities(cached_caps)
+    
+    # Database setup and a fresh ffmpeg probe run in the background so the
+    # bot starts accepting updates immediately; either failing stops polling
+    threading.Thread(target=initialize_backend, name="backend-init", daemon=True).start()
+    
     # Start polling
     try:
         logger.info("Bot is starting to poll...")
         bot.infinity_polling(timeout=30, long_polling_timeout=30)
     except Exception as e:
         logger.error(f"Error starting bot: {e}")
+    finally:
+        polling_finished.set()
 
 if __name__ == '__main__':
     main()
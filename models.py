@@ -1,8 +1,10 @@
 """Database models for Kruzhok Bot"""
 
 import os
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, BigInteger, String, DateTime, Text, Boolean
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, func, text, Column, Integer, BigInteger, Float, String, Date, DateTime, Text, Boolean, UniqueConstraint
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -41,32 +43,198 @@ class UserLanguage(Base):
     def __repr__(self):
         return f"<UserLanguage(user_id={self.user_id}, language={self.language_code})>"
 
+class UserStats(Base):
+    """Per-user rollup of user_history, maintained as history rows are written"""
+    __tablename__ = 'user_stats'
+    
+    user_id = Column(BigInteger, primary_key=True)
+    total_kruzhoks = Column(Integer, nullable=False, default=0)
+    total_bytes = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<UserStats(user_id={self.user_id}, total={self.total_kruzhoks})>"
+
+class UsageTotals(Base):
+    """Single-row rollup of all-time totals across users"""
+    __tablename__ = 'usage_totals'
+    
+    id = Column(Integer, primary_key=True)  # Always 1
+    total_users = Column(Integer, nullable=False, default=0)
+    total_kruzhoks = Column(BigInteger, nullable=False, default=0)
+    total_bytes = Column(BigInteger, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<UsageTotals(users={self.total_users}, total={self.total_kruzhoks})>"
+
+class DailyEffectStats(Base):
+    """Per-day x effect x media type rollup of user_history"""
+    __tablename__ = 'daily_effect_stats'
+    __table_args__ = (UniqueConstraint('day', 'effect_type', 'media_type', name='uq_daily_effect_stats'),)
+    
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    effect_type = Column(Integer, nullable=False)
+    media_type = Column(String(20), nullable=False)
+    kruzhok_count = Column(Integer, nullable=False, default=0)
+    total_bytes = Column(BigInteger, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<DailyEffectStats(day={self.day}, effect={self.effect_type}, count={self.kruzhok_count})>"
+
+class EffectSizeStats(Base):
+    """Per effect x media type output size rollup, used to predict encoded sizes"""
+    __tablename__ = 'effect_size_stats'
+    __table_args__ = (UniqueConstraint('effect_type', 'media_type', name='uq_effect_size_stats'),)
+    
+    id = Column(Integer, primary_key=True)
+    effect_type = Column(Integer, nullable=False)
+    media_type = Column(String(20), nullable=False)
+    sample_count = Column(Integer, nullable=False, default=0)
+    total_bytes = Column(BigInteger, nullable=False, default=0)
+    total_seconds = Column(Float, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<EffectSizeStats(effect={self.effect_type}, media={self.media_type}, samples={self.sample_count})>"
+
+class BackfillMarker(Base):
+    """Records one-off rebuilds of derived tables so they run only once"""
+    __tablename__ = 'backfill_markers'
+    
+    name = Column(String(50), primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<BackfillMarker(name={self.name}, created_at={self.created_at})>"
+
+class JobJournal(Base):
+    """Append-only journal of kruzhok job stages, used to resume after a restart"""
+    __tablename__ = 'job_journal'
+    
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String(32), nullable=False, index=True)
+    user_id = Column(BigInteger, nullable=False, index=True)
+    chat_id = Column(BigInteger, nullable=False)
+    stage = Column(String(20), nullable=False)  # downloading, downloaded, encoding, encoded, uploaded, saved, done, failed, merged
+    data = Column(Text, nullable=False)  # JSON snapshot of the job (paths, effect, file_id)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<JobJournal(job_id={self.job_id}, stage={self.stage}, created_at={self.created_at})>"
+
+# Job stages after which nothing is left to resume
+JOB_FINAL_STAGES = ('done', 'failed', 'merged')
+
 # Database setup
+# The engine is created on first use so that importing this module is cheap
+# and does not require DATABASE_URL (or a reachable database) at import time.
 DATABASE_URL = os.environ.get('DATABASE_URL')
-if not DATABASE_URL:
-    raise ValueError("DATABASE_URL environment variable is required")
-
-engine = create_engine(
-    DATABASE_URL, 
-    echo=False,
-    pool_pre_ping=True,
-    pool_recycle=300,
-    connect_args={"sslmode": "require"}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+_engine = None
+_session_factory = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Get the database engine, creating it on first call"""
+    global _engine, _session_factory
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                if not DATABASE_URL:
+                    raise ValueError("DATABASE_URL environment variable is required")
+                engine = create_engine(
+                    DATABASE_URL,
+                    echo=False,
+                    pool_pre_ping=True,
+                    pool_recycle=300,
+                    connect_args={"sslmode": "require"}
+                )
+                _session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+                _engine = engine
+    return _engine
 
 def create_tables():
     """Create all tables"""
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=get_engine())
 
 def get_db_session():
     """Get database session"""
-    return SessionLocal()
+    get_engine()
+    return _session_factory()
 
-def save_user_history(user_id, username, first_name, file_id, original_media_type, effect_type, effect_name, file_size=None):
-    """Save user's kruzhok to history"""
+def _add_to_usage_stats(session, user_id, day, media_type, effect_type, count, size):
+    """Increment the usage rollups inside the caller's transaction"""
+    user_stmt = insert(UserStats).values(
+        user_id=user_id,
+        total_kruzhoks=count,
+        total_bytes=size,
+        updated_at=datetime.utcnow()
+    )
+    user_total = session.execute(user_stmt.on_conflict_do_update(
+        index_elements=[UserStats.user_id],
+        set_={
+            'total_kruzhoks': UserStats.total_kruzhoks + user_stmt.excluded.total_kruzhoks,
+            'total_bytes': UserStats.total_bytes + user_stmt.excluded.total_bytes,
+            'updated_at': user_stmt.excluded.updated_at
+        }
+    ).returning(UserStats.total_kruzhoks)).scalar()
+    # The user's row was just created if its total is only what was added now
+    new_users = 1 if user_total == count else 0
+    
+    totals_stmt = insert(UsageTotals).values(
+        id=1,
+        total_users=new_users,
+        total_kruzhoks=count,
+        total_bytes=size
+    )
+    session.execute(totals_stmt.on_conflict_do_update(
+        index_elements=[UsageTotals.id],
+        set_={
+            'total_users': UsageTotals.total_users + totals_stmt.excluded.total_users,
+            'total_kruzhoks': UsageTotals.total_kruzhoks + totals_stmt.excluded.total_kruzhoks,
+            'total_bytes': UsageTotals.total_bytes + totals_stmt.excluded.total_bytes
+        }
+    ))
+    
+    daily_stmt = insert(DailyEffectStats).values(
+        day=day,
+        effect_type=effect_type,
+        media_type=media_type,
+        kruzhok_count=count,
+        total_bytes=size
+    )
+    session.execute(daily_stmt.on_conflict_do_update(
+        constraint='uq_daily_effect_stats',
+        set_={
+            'kruzhok_count': DailyEffectStats.kruzhok_count + daily_stmt.excluded.kruzhok_count,
+            'total_bytes': DailyEffectStats.total_bytes + daily_stmt.excluded.total_bytes
+        }
+    ))
+
+def _add_to_size_stats(session, media_type, effect_type, size, seconds):
+    """Add one encoded output to the size prediction rollup"""
+    stmt = insert(EffectSizeStats).values(
+        effect_type=effect_type,
+        media_type=media_type,
+        sample_count=1,
+        total_bytes=size,
+        total_seconds=seconds
+    )
+    session.execute(stmt.on_conflict_do_update(
+        constraint='uq_effect_size_stats',
+        set_={
+            'sample_count': EffectSizeStats.sample_count + 1,
+            'total_bytes': EffectSizeStats.total_bytes + stmt.excluded.total_bytes,
+            'total_seconds': EffectSizeStats.total_seconds + stmt.excluded.total_seconds
+        }
+    ))
+
+def save_user_history(user_id, username, first_name, file_id, original_media_type, effect_type, effect_name, file_size=None, duration=None):
+    """Save user's kruzhok to history (pass duration to use the size as a prediction sample)"""
     session = get_db_session()
     try:
+        # One timestamp so the rollup day always matches the history row
+        created_at = datetime.utcnow()
         history_entry = UserHistory(
             user_id=user_id,
             username=username,
@@ -75,9 +243,13 @@ def save_user_history(user_id, username, first_name, file_id, original_media_typ
             original_media_type=original_media_type,
             effect_type=effect_type,
             effect_name=effect_name,
+            created_at=created_at,
             file_size=file_size
         )
         session.add(history_entry)
+        _add_to_usage_stats(session, user_id, created_at.date(), original_media_type, effect_type, 1, file_size or 0)
+        if file_size and duration:
+            _add_to_size_stats(session, original_media_type, effect_type, file_size, duration)
         session.commit()
         return True
     except Exception as e:
@@ -107,16 +279,128 @@ def get_total_user_kruzhoks(user_id):
     """Get total count of user's kruzhoks"""
     session = get_db_session()
     try:
-        count = session.query(UserHistory).filter(
-            UserHistory.user_id == user_id
-        ).count()
-        return count
+        stats = session.get(UserStats, user_id)
+        return stats.total_kruzhoks if stats else 0
     except Exception as e:
         print(f"Error getting count: {e}")
         return 0
     finally:
         session.close()
 
+def get_effect_byte_rate(effect_type, media_type, min_samples=5):
+    """Get average output bytes per second for an effect, None without enough samples"""
+    session = get_db_session()
+    try:
+        stats = session.query(EffectSizeStats).filter(
+            EffectSizeStats.effect_type == effect_type,
+            EffectSizeStats.media_type == media_type
+        ).first()
+        if stats is None or stats.sample_count < min_samples or not stats.total_seconds:
+            return None
+        return stats.total_bytes / stats.total_seconds
+    except Exception as e:
+        print(f"Error getting effect byte rate: {e}")
+        return None
+    finally:
+        session.close()
+
+def backfill_usage_stats():
+    """Build the usage rollups from user_history once, on the first start after they were added"""
+    session = get_db_session()
+    try:
+        if session.get(BackfillMarker, 'usage_stats') is not None:
+            return False
+        
+        # Block history writes so the rebuild sees a consistent set of rows
+        session.execute(text("LOCK TABLE user_history IN SHARE MODE"))
+        session.query(UserStats).delete(synchronize_session=False)
+        session.query(UsageTotals).delete(synchronize_session=False)
+        session.query(DailyEffectStats).delete(synchronize_session=False)
+        day = func.date(UserHistory.created_at)
+        rows = session.query(
+            UserHistory.user_id,
+            day,
+            UserHistory.original_media_type,
+            UserHistory.effect_type,
+            func.count(UserHistory.id),
+            func.coalesce(func.sum(UserHistory.file_size), 0)
+        ).group_by(
+            UserHistory.user_id, day, UserHistory.original_media_type, UserHistory.effect_type
+        ).all()
+        
+        for user_id, row_day, media_type, effect_type, count, size in rows:
+            _add_to_usage_stats(session, user_id, row_day, media_type, effect_type, count, size)
+        session.add(BackfillMarker(name='usage_stats'))
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"Error backfilling usage stats: {e}")
+        return False
+    finally:
+        session.close()
+
+def backfill_size_stats():
+    """Seed size prediction samples from photo history once"""
+    # Photo kruzhoks always last 5 seconds and were encoded with uncapped CRF,
+    # so their sizes are exact samples. Video history has no duration, so
+    # video prediction starts from new encodes.
+    session = get_db_session()
+    try:
+        if session.get(BackfillMarker, 'effect_size_stats') is not None:
+            return False
+        
+        rows = session.query(
+            UserHistory.effect_type,
+            func.count(UserHistory.id),
+            func.sum(UserHistory.file_size)
+        ).filter(
+            UserHistory.original_media_type == 'photo',
+            UserHistory.file_size.isnot(None)
+        ).group_by(UserHistory.effect_type).all()
+        
+        for effect_type, count, size in rows:
+            session.add(EffectSizeStats(
+                effect_type=effect_type,
+                media_type='photo',
+                sample_count=count,
+                total_bytes=size,
+                total_seconds=count * 5.0
+            ))
+        session.add(BackfillMarker(name='effect_size_stats'))
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"Error backfilling size stats: {e}")
+        return False
+    finally:
+        session.close()
+
+def get_usage_stats(days=7):
+    """Get usage totals and per-day x effect x media type rollups for recent days"""
+    session = get_db_session()
+    try:
+        since = datetime.utcnow().date() - timedelta(days=days - 1)
+        totals = session.get(UsageTotals, 1)
+        daily = session.query(DailyEffectStats).filter(
+            DailyEffectStats.day >= since
+        ).order_by(
+            DailyEffectStats.day.desc(),
+            DailyEffectStats.kruzhok_count.desc()
+        ).all()
+        return {
+            'total_users': totals.total_users if totals else 0,
+            'total_kruzhoks': totals.total_kruzhoks if totals else 0,
+            'total_bytes': totals.total_bytes if totals else 0,
+            'daily': daily
+        }
+    except Exception as e:
+        print(f"Error getting usage stats: {e}")
+        return None
+    finally:
+        session.close()
+
 def set_user_language(user_id, username, first_name, language_code):
     """Set or update user's preferred language"""
     session = get_db_session()
@@ -166,5 +450,66 @@ def get_user_language(user_id):
     except Exception as e:
         print(f"Error getting user language: {e}")
         return 'uz'
+    finally:
+        session.close()
+
+def append_job_event(job_id, user_id, chat_id, stage, data):
+    """Append a job stage to the journal"""
+    session = get_db_session()
+    try:
+        session.add(JobJournal(
+            job_id=job_id,
+            user_id=user_id,
+            chat_id=chat_id,
+            stage=stage,
+            data=data
+        ))
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        print(f"Error appending job event: {e}")
+        return False
+    finally:
+        session.close()
+
+def get_interrupted_jobs():
+    """Get the latest journal entry of every job that did not finish"""
+    session = get_db_session()
+    try:
+        latest_ids = session.query(
+            func.max(JobJournal.id)
+        ).group_by(JobJournal.job_id).subquery()
+        
+        jobs = session.query(JobJournal).filter(
+            JobJournal.id.in_(latest_ids.select()),
+            JobJournal.stage.notin_(JOB_FINAL_STAGES)
+        ).order_by(JobJournal.id).all()
+        return jobs
+    except Exception as e:
+        print(f"Error getting interrupted jobs: {e}")
+        return []
+    finally:
+        session.close()
+
+def prune_job_journal(days=7):
+    """Delete journal entries of finished jobs older than the given number of days"""
+    session = get_db_session()
+    try:
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        # A final stage is always a job's last entry, so these jobs are over
+        finished_jobs = session.query(JobJournal.job_id).filter(
+            JobJournal.stage.in_(JOB_FINAL_STAGES)
+        )
+        deleted = session.query(JobJournal).filter(
+            JobJournal.created_at < cutoff,
+            JobJournal.job_id.in_(finished_jobs)
+        ).delete(synchronize_session=False)
+        session.commit()
+        return deleted
+    except Exception as e:
+        session.rollback()
+        print(f"Error pruning job journal: {e}")
+        return 0
     finally:
         session.close()
\ No newline at end of file